@@ -3,15 +3,24 @@
 用于删除之前的处理结果和缓存
 """
 
+import os
 import shutil
+import subprocess
 from pathlib import Path
 
+def _fast_rmtree(path):
+    """删除整个目录树，POSIX 上使用原生 rm -rf（比 shutil.rmtree 快得多）"""
+    if os.name != "nt" and shutil.which("rm"):
+        subprocess.check_call(["rm", "-rf", "--", str(path)])
+    else:
+        shutil.rmtree(path)
+
 def clean_results():
     """删除之前的识别结果"""
     results_folder = Path("data/results")
     if results_folder.exists():
         print(f"删除结果文件夹: {results_folder}")
-        shutil.rmtree(results_folder)
+        _fast_rmtree(results_folder)
         print("✅ 已删除")
     else:
         print("✓ 结果文件夹不存在（已是干净状态）")
@@ -24,27 +33,35 @@ def clean_cache():
     ]
 
     # 删除本地嵌入缓存
-    embeddings_cache = Path("data/embeddings_cache.pkl")
-    if embeddings_cache.exists():
-        print(f"删除嵌入缓存: {embeddings_cache}")
-        try:
-            embeddings_cache.unlink()
-            print("✅ 已删除")
-        except Exception as e:
-            print(f"⚠️  删除失败: {e}")
-    else:
-        print(f"✓ 嵌入缓存不存在: {embeddings_cache}")
+    embeddings_caches = [
+        Path("data/embeddings_cache.npy"),  # run_classification.py / video_realtime.py 缓存
+        Path("data/embeddings_cache.json"),  # run_classification.py / video_realtime.py 缓存（路径）
+        Path("data/embeddings_cache.pkl"),  # 旧版 video_realtime.py 缓存
+    ]
+    for embeddings_cache in embeddings_caches:
+        if embeddings_cache.exists():
+            print(f"删除嵌入缓存: {embeddings_cache}")
+            try:
+                embeddings_cache.unlink()
+                print("✅ 已删除")
+            except Exception as e:
+                print(f"⚠️  删除失败: {e}")
+        else:
+            print(f"✓ 嵌入缓存不存在: {embeddings_cache}")
 
+    # 汇总输出，循环结束后一次性写出
+    lines = []
     for cache_dir in cache_folders:
         if cache_dir.exists():
-            print(f"删除缓存: {cache_dir}")
+            lines.append(f"删除缓存: {cache_dir}")
             try:
-                shutil.rmtree(cache_dir)
-                print("✅ 已删除")
+                _fast_rmtree(cache_dir)
+                lines.append("✅ 已删除")
             except Exception as e:
-                print(f"⚠️  删除失败: {e}")
+                lines.append(f"⚠️  删除失败: {e}")
         else:
-            print(f"✓ 缓存目录不存在: {cache_dir}")
+            lines.append(f"✓ 缓存目录不存在: {cache_dir}")
+    print("\n".join(lines))
 
 def reset_all():
     """完全重置 - 删除所有结果和缓存"""
@@ -3,10 +3,17 @@
 使用你的数据进行人脸识别和分类
 """
 
+import os
 from pathlib import Path
+import torch
 from few_shot_face_classification import detect_and_export
 from few_shot_face_classification.utils import Conflict
 
+def _list_files(folder):
+    """列出文件夹中所有带扩展名的文件名（os.scandir 单次遍历，不构造 Path 对象）"""
+    with os.scandir(folder) as it:
+        return [e.name for e in it if e.is_file(follow_symlinks=False) and "." in e.name]
+
 def main():
     print("="*60)
     print("开始人脸识别和分类任务")
@@ -16,14 +23,14 @@ def main():
     DATA_RAW = Path("data/raw")          # 原始图片文件夹
     DATA_LABELED = Path("data/labeled")  # 标注人脸文件夹
     DATA_RESULTS = Path("data/results")  # 结果输出文件夹
-    CACHE_FILE = Path("data/embeddings_cache.pkl")  # 嵌入缓存
+    CACHE_FILE = Path("data/embeddings_cache.npy")  # 嵌入缓存（路径保存在同名 .json 中）
     
     # 创建结果文件夹
     DATA_RESULTS.mkdir(exist_ok=True, parents=True)
     
     # 显示数据统计
-    raw_images = list(DATA_RAW.glob("*.*"))
-    labeled_images = list(DATA_LABELED.glob("*.*"))
+    raw_images = _list_files(DATA_RAW)
+    labeled_images = _list_files(DATA_LABELED)
     
     print(f"\n📁 数据统计:")
     print(f"  - 原始图片数量: {len(raw_images)}")
@@ -32,7 +39,7 @@ def main():
     # 统计标注的人数
     names = set()
     for img in labeled_images:
-        name = img.stem.split('_')[0]  # 获取姓名部分
+        name = os.path.splitext(img)[0].split('_')[0]  # 获取姓名部分
         if name != 'none':
             names.add(name)
     
@@ -46,6 +53,9 @@ def main():
     print(f"  ⚠️  处理{len(raw_images)}张图片可能需要几分钟时间")
     print()
     
+    # 允许 TF32 矩阵乘法（仅 GPU 有效，本脚本进程内生效）
+    torch.set_float32_matmul_precision("high")
+    
     # 执行分类
     try:
         detect_and_export(
@@ -66,10 +76,13 @@ def main():
         
         # 显示结果统计
         result_folders = [f for f in DATA_RESULTS.iterdir() if f.is_dir()]
+        lines = []
         for folder in sorted(result_folders):
-            images_count = len(list(folder.glob("*.*")))
+            images_count = sum(1 for e in os.scandir(folder) if e.is_file() and "." in e.name)
             if images_count > 0:
-                print(f"  - {folder.name}: {images_count} 张图片")
+                lines.append(f"  - {folder.name}: {images_count} 张图片")
+        if lines:
+            print("\n".join(lines))
         
         print("\n🎉 任务完成！现在可以查看结果文件夹。")
         
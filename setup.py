@@ -18,6 +18,11 @@ INSTALL_REQUIRES = [
     'numpy',
 ]
 
+EXTRAS_REQUIRE = {
+    'simd': ['simsimd'],
+    'numba': ['numba'],
+}
+
 setup(
         name="few_shot_face_classification",
         version="0.0.1",
@@ -30,5 +35,6 @@ setup(
         package_dir={"": "src"},
         packages=find_packages(where="src"),
         install_requires=INSTALL_REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         include_package_data=True,
 )
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 """Environment bootstrapper for few-shot face classification."""
 import argparse
-import importlib
+import importlib.metadata
+import importlib.util
+import re
 import subprocess
 import sys
 from pathlib import Path
@@ -25,31 +27,31 @@ def _run(cmd):
 
 
 def _is_installed(mod_name: str) -> bool:
+    # find_spec only locates the module, it does not execute (import) it
+    return importlib.util.find_spec(mod_name) is not None
+
+
+def _dist_version(spec: str) -> str:
+    # Read the version from the installed metadata rather than importing the package
+    dist_name = re.split(r"[<>=~!\[\s]", spec, maxsplit=1)[0]
     try:
-        importlib.import_module(mod_name)
-        return True
-    except ImportError:
-        return False
+        return importlib.metadata.version(dist_name)
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
 
 
 def _ensure_package(mod_name: str, spec: str, pip_args: list[str]) -> None:
-    try:
-        mod = importlib.import_module(mod_name)
-        ver = getattr(mod, "__version__", "unknown")
-        print(f"OK {mod_name} {ver}")
+    if _is_installed(mod_name):
+        print(f"OK {mod_name} {_dist_version(spec)}")
         return
-    except ImportError:
-        print(f"Installing {spec}...")
+    print(f"Installing {spec}...")
     _run([sys.executable, "-m", "pip", "install", spec, *pip_args])
 
 
 def _ensure_torch(torch_spec: str, index_url: str | None) -> None:
     missing = [m for m in TORCH_IMPORTS if not _is_installed(m)]
     if not missing:
-        versions = []
-        for m in TORCH_IMPORTS:
-            ver = getattr(importlib.import_module(m), "__version__", "unknown")
-            versions.append(f"{m} {ver}")
+        versions = [f"{m} {_dist_version(m)}" for m in TORCH_IMPORTS]
         print("OK torch stack", " | ".join(versions))
         return
 
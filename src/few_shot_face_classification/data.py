@@ -1,7 +1,7 @@
 """Load in the data."""
-from glob import glob
+import os
 from pathlib import Path
-from typing import Any, List
+from typing import Any, Iterator, List, Optional, Tuple
 
 from PIL import ExifTags, Image
 
@@ -28,14 +28,31 @@ def _fix_rot(im: Image) -> Image:
     return im
 
 
+def iter_im_paths(folder: Path) -> Iterator[Path]:
+    """Lazily yield the paths to all images present in the folder, in directory order."""
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.startswith('.') or os.path.splitext(entry.name)[1] not in IMG_SUFFIX:
+                continue
+            yield folder / entry.name
+
+
 def get_im_paths(folder: Path) -> List[Path]:
     """Get the paths to all images present in the folder."""
-    return [Path(path) for path in sorted(glob(str(folder / '*'))) if Path(path).suffix in IMG_SUFFIX]
+    return sorted(iter_im_paths(folder))
 
 
-def load_single(path: Path) -> Image:
-    """Load a single image."""
-    return _fix_rot(Image.open(path).convert('RGB'))
+def load_single(path: Path, draft_size: Optional[Tuple[int, int]] = None) -> Image:
+    """
+    Load a single image.
+    
+    :param path: Path of the image to load
+    :param draft_size: If provided, let the JPEG decoder downscale (by 1/2, 1/4 or 1/8) while staying above this size
+    """
+    im = Image.open(path)
+    if draft_size is not None:
+        im.draft('RGB', draft_size)
+    return _fix_rot(im.convert('RGB'))
 
 
 def load_folder(folder: Path) -> List[Any]:
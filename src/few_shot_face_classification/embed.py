@@ -1,28 +1,62 @@
 """Methods to embed results."""
 import warnings
-from multiprocessing import Pool, cpu_count
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
+import torch
 from PIL import Image
 from facenet_pytorch import InceptionResnetV1, MTCNN
 from tqdm import tqdm
 
 from few_shot_face_classification.data import get_im_paths, load_single
 from few_shot_face_classification.exceptions import MultipleFaceException, NoFaceException
+from few_shot_face_classification.utils import DRAFT_SIZE
 
 # Filter out the user warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# Number of threads used to decode images while the networks run
+N_LOADERS = 4
 
-def get_networks() -> Tuple[MTCNN, InceptionResnetV1]:
-    """Get all the networks for image detection."""
+# Size (in pixels) of the face crops produced by MTCNN and embedded by VGGFace2
+FACE_SIZE = 160
+
+
+def get_networks(compiled: bool = False, half: bool = False) -> Tuple[MTCNN, InceptionResnetV1]:
+    """
+    Get all the networks for image detection, placed on the GPU when one is available, loaded once per process.
+    
+    :param compiled: Compile the VGGFace2 network with torch.compile (torch>=2.0), slow start but faster inference
+    :param half: Run both networks in half precision (GPU only, ignored on CPU)
+    """
+    # Normalise the arguments, so every way of calling shares the same cached networks
+    return _load_networks(bool(compiled), bool(half))
+
+
+@lru_cache(maxsize=None)
+def _load_networks(compiled: bool, half: bool) -> Tuple[MTCNN, InceptionResnetV1]:
+    """Load the networks, cached per (compiled, half) combination."""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    
     # Create MTCNN network that extracts all potential faces from the images
-    mtcnn = MTCNN(keep_all=True)
+    mtcnn = MTCNN(keep_all=True, device=device)
     
     # Use the VGGFace2 to create the embedding
-    vggface2 = InceptionResnetV1(pretrained='vggface2').eval()
+    vggface2 = InceptionResnetV1(pretrained='vggface2', device=device).eval()
+    
+    # Halve the weights, MTCNN casts its input to the dtype of its weights itself
+    if half and device.type == 'cuda':
+        mtcnn = mtcnn.half()
+        vggface2 = vggface2.half()
+    
+    # Specialise the network for the fixed face-crop shape, warm up once so compilation happens here
+    if compiled and hasattr(torch, 'compile'):
+        vggface2 = torch.compile(vggface2, mode='reduce-overhead', fullgraph=True)
+        dtype = next(vggface2.parameters()).dtype
+        _ = vggface2(torch.zeros(1, 3, FACE_SIZE, FACE_SIZE, device=device, dtype=dtype))
     return mtcnn, vggface2
 
 
@@ -58,8 +92,9 @@ def validate_face(
             raise MultipleFaceException
         
         # Check if embedding happens correctly
+        param = next(vggface2.parameters())
         for face_arr in img_cropped:
-            _ = vggface2(face_arr.unsqueeze(0)).detach().numpy()[0]
+            _ = vggface2(face_arr.unsqueeze(0).to(param.device, param.dtype)).detach().float().cpu().numpy()[0]
     except KeyboardInterrupt:
         raise KeyboardInterrupt
     except Exception:
@@ -67,6 +102,69 @@ def validate_face(
     return True
 
 
+def validate_faces(
+        ims: List[Image],
+        val_single: bool,
+        mtcnn: Optional[MTCNN] = None,
+) -> List[bool]:
+    """
+    Validate a batch of images on detected faces, running the face detection batch-wise.
+    
+    :param ims: Images to validate
+    :param val_single: Validate that strictly one face is present in each image
+    :param mtcnn: MTCNN network for face extraction
+    :return: Whether or not each of the images is valid
+    """
+    # Create MTCNN network if not provided
+    if mtcnn is None:
+        mtcnn, _ = get_networks()
+    
+    # Detect the faces of all images at once, an image is invalid if no (or multiple) faces are found
+    valid = []
+    for boxes in _detect_grouped(ims, mtcnn=mtcnn):
+        n_faces = 0 if boxes is None else len(boxes)
+        valid.append(n_faces == 1 if val_single else n_faces > 0)
+    return valid
+
+
+def _detect_grouped(ims: List[Image], mtcnn: MTCNN) -> List[Optional[np.ndarray]]:
+    """
+    Detect the faces in the images, batch-wise per group of equal image dimensions (as required by MTCNN).
+    
+    :param ims: Images in which the faces are detected
+    :param mtcnn: MTCNN network for face extraction
+    :return: Bounding boxes of the faces in every image, None if no faces are found or the detection fails
+    """
+    # MTCNN can only batch images of equal dimensions, group them accordingly
+    groups: Dict[Tuple[int, int], List[int]] = {}
+    for i, im in enumerate(ims):
+        groups.setdefault(im.size, []).append(i)
+    
+    # Detect the faces of every group at once
+    batch_boxes: List[Optional[np.ndarray]] = [None] * len(ims)
+    for idxs in groups.values():
+        try:
+            group_boxes = mtcnn.detect([ims[i] for i in idxs])[0]
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except Exception:
+            # The group failed as a whole (e.g. out of memory), retry image per image so only failing images are lost
+            group_boxes = [_detect_single(mtcnn, ims[i]) for i in idxs]
+        for i, boxes in zip(idxs, group_boxes):
+            batch_boxes[i] = boxes
+    return batch_boxes
+
+
+def _detect_single(mtcnn: MTCNN, im: Image) -> Optional[np.ndarray]:
+    """Detect the faces in a single image, None if none are found or the detection fails."""
+    try:
+        return mtcnn.detect(im)[0]
+    except KeyboardInterrupt:
+        raise KeyboardInterrupt
+    except Exception:
+        return None
+
+
 def embed(
         im: Image,
         mtcnn: Optional[MTCNN] = None,
@@ -79,20 +177,60 @@ def embed(
     :param mtcnn: MTCNN network for face extraction
     :param vggface2: VGGFace2 network to embed the face
     """
+    return embed_with_boxes(im, mtcnn=mtcnn, vggface2=vggface2)[1]
+
+
+def embed_with_boxes(
+        im: Image,
+        mtcnn: Optional[MTCNN] = None,
+        vggface2: Optional[InceptionResnetV1] = None,
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """
+    Create embeddings for every face detected by the algorithm, together with the bounding boxes of these faces.
+    
+    :param im: Image to embed
+    :param mtcnn: MTCNN network for face extraction
+    :param vggface2: VGGFace2 network to embed the face
+    :return: Bounding box [x1, y1, x2, y2] and embedding of every detected face
+    """
     # Create MTCNN network if not provided
     if mtcnn is None or vggface2 is None:
         mtcnn, vggface2 = get_networks()
     
-    # Crop out the faces, return empty list if none detected
-    img_cropped = mtcnn(im)
-    if img_cropped is None:
-        return []
+    # Detect the faces, return empty lists if none detected
+    boxes, _ = mtcnn.detect(im)
+    if boxes is None:
+        return [], []
+    return list(boxes), embed_faces(im, boxes, mtcnn=mtcnn, vggface2=vggface2)
+
+
+def embed_faces(
+        im: Image,
+        boxes: np.ndarray,
+        mtcnn: Optional[MTCNN] = None,
+        vggface2: Optional[InceptionResnetV1] = None,
+) -> List[np.ndarray]:
+    """
+    Create embeddings for the faces at the given bounding boxes, without running the face detection.
+    
+    :param im: Image to embed
+    :param boxes: Bounding boxes [[x1, y1, x2, y2], ...] of the faces in the image
+    :param mtcnn: MTCNN network for face extraction
+    :param vggface2: VGGFace2 network to embed the face
+    """
+    # Create MTCNN network if not provided
+    if mtcnn is None or vggface2 is None:
+        mtcnn, vggface2 = get_networks()
     
-    # Embed all detected faces
+    # Crop out the faces
+    img_cropped = mtcnn.extract(im, np.asarray(boxes), None)
+    
+    # Embed all cropped faces, in the precision of the network but returned as float32
+    param = next(vggface2.parameters())
     embeddings = []
     for face_arr in img_cropped:
         embeddings.append(
-                vggface2(face_arr.unsqueeze(0)).detach().numpy()[0]
+                vggface2(face_arr.unsqueeze(0).to(param.device, param.dtype)).detach().float().cpu().numpy()[0]
         )
     return embeddings
 
@@ -110,9 +248,12 @@ def embed_folder(
     for i in range(0, len(paths), batch_size):
         chunks.append(paths[i:i + batch_size])
     
-    # Create embeddings for each chunk
-    with Pool(cpu_count() - 2) as p:
-        results = list(tqdm(p.imap(embed_batch, chunks), total=len(chunks), desc="Processing"))
+    # Load the networks once, images are decoded on background threads while the networks run
+    mtcnn, vggface2 = get_networks()
+    results = []
+    with ThreadPoolExecutor(max_workers=N_LOADERS) as loader:
+        for chunk in tqdm(chunks, desc="Processing"):
+            results.append(embed_batch(chunk, mtcnn=mtcnn, vggface2=vggface2, loader=loader))
     
     # Flatten out the results and return
     return [x for y in results for x in y[0]], [x for y in results for x in y[1]]
@@ -120,20 +261,49 @@ def embed_folder(
 
 def embed_batch(
         paths: List[Path],
-) -> Tuple[List[Path], List[np.ndarray]]:
-    """Embed a batch of images as specified by their path, used in multiprocessing."""
-    # Load in the networks
-    mtcnn, vggface2 = get_networks()
+        mtcnn: Optional[MTCNN] = None,
+        vggface2: Optional[InceptionResnetV1] = None,
+        loader: Optional[Executor] = None,
+) -> Tuple[List[Path], List[np.ndarray], List[np.ndarray]]:
+    """
+    Embed a batch of images as specified by their path.
     
-    # Embed all the images
-    return_path, return_arr = [], []
-    for path in paths:
-        im = load_single(path)
-        emb = embed(
-                im=im,
-                mtcnn=mtcnn,
-                vggface2=vggface2,
-        )
-        return_path += [path] * len(emb)
-        return_arr += emb
-    return return_path, return_arr
+    :param paths: Paths of the images to embed
+    :param mtcnn: MTCNN network for face extraction
+    :param vggface2: VGGFace2 network to embed the face
+    :param loader: Executor used to decode the images in the background, decoded in-line if not provided
+    :return: Image path, embedding, and bounding box (in full-resolution image coordinates) of every detected face
+    """
+    # Load in the networks if not provided
+    if mtcnn is None or vggface2 is None:
+        mtcnn, vggface2 = get_networks()
+    
+    # Decode the images (in the background if possible), at reduced scale since only faces are extracted
+    ims = list(loader.map(_load_drafted, paths) if loader is not None else map(_load_drafted, paths))
+    
+    # Detect the faces of all images at once, images for which detection fails are skipped
+    batch_boxes = _detect_grouped([im for im, _ in ims], mtcnn=mtcnn)
+    
+    # Crop out the faces of all the images
+    return_path, return_box, faces = [], [], []
+    for path, (im, scale), boxes in zip(paths, ims, batch_boxes):
+        if boxes is None:
+            continue
+        faces.append(mtcnn.extract(im, boxes, None))
+        return_path += [path] * len(boxes)
+        return_box += [box * scale for box in boxes]
+    if not faces:
+        return [], [], []
+    
+    # Embed all cropped faces of the batch in a single forward pass
+    param = next(vggface2.parameters())
+    embs = vggface2(torch.cat(faces).to(param.device, param.dtype)).detach().float().cpu().numpy()
+    return return_path, list(embs), return_box
+
+
+def _load_drafted(path: Path) -> Tuple[Image, np.ndarray]:
+    """Load the image at reduced (draft) scale, together with the factors that scale its coordinates back up."""
+    with Image.open(path) as full:
+        full_size = full.size
+    im = load_single(path, draft_size=DRAFT_SIZE)
+    return im, np.array([full_size[0] / im.width, full_size[1] / im.height] * 2, dtype=np.float32)
@@ -33,3 +33,10 @@ class InvalidImageException(Exception):
         if path is not None:
             msg += f" ({path})"
         super(InvalidImageException, self).__init__(msg)
+
+
+class NoLabeledFaceException(Exception):
+    """Exception thrown when there are no labeled faces to compare against."""
+    
+    def __init__(self) -> None:
+        super(NoLabeledFaceException, self).__init__("No labeled faces to compare against!")
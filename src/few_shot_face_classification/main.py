@@ -1,19 +1,26 @@
 """Complete A to Z functions on the data."""
-import pickle
-from glob import glob
-from multiprocessing import Pool, cpu_count
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from random import getrandbits
-from shutil import move
-from typing import Any, List, Optional, Set, Tuple
+from shutil import rmtree
+from tempfile import mkdtemp
+from typing import Iterator, List, Optional, Set, Tuple
 
+import numpy as np
+import torch
 from tqdm import tqdm
 
-from few_shot_face_classification.data import get_im_paths, load_single
-from few_shot_face_classification.embed import embed, embed_batch, embed_folder, get_networks, validate_face
-from few_shot_face_classification.exceptions import InvalidImageException
-from few_shot_face_classification.similarity import export, get_classes
-from few_shot_face_classification.utils import Conflict
+from few_shot_face_classification.data import get_im_paths, iter_im_paths, load_single
+from few_shot_face_classification.embed import N_LOADERS, embed, embed_batch, embed_folder, get_networks, validate_faces
+from few_shot_face_classification.exceptions import InvalidImageException, NoLabeledFaceException
+from few_shot_face_classification.similarity import as_matrix, export, get_classes, squared_norms
+from few_shot_face_classification.utils import DRAFT_SIZE, Conflict, get_class
+
+# Number of threads used to draw and write the exported images while the networks run
+N_WRITERS = 4
 
 
 def _load_or_create_embeddings(
@@ -21,56 +28,90 @@ def _load_or_create_embeddings(
         batch_size: int = 32,
         cache_file: Optional[Path] = None,
         use_cache: bool = True,
-) -> Tuple[List[Path], List[Any]]:
+) -> Tuple[List[Path], np.ndarray]:
     """Load labeled embeddings from cache when valid, otherwise compute and persist.
 
+    The embeddings are returned (and cached) as a single stacked ``[N, D]`` float32 matrix, stored
+    with ``numpy.save`` in the cache file and loaded memory-mapped. The relative paths of the
+    labeled faces are stored next to it, in a JSON file with the same name.
     The cache is considered valid when it exists and is newer than any file in the
     labeled folder. If loading fails, we transparently recompute and overwrite.
     """
     # Short-circuit if caching is disabled or no cache file provided
     if not use_cache or cache_file is None:
-        return embed_folder(labeled_f, batch_size=batch_size)
+        labeled_paths, labeled_embs = embed_folder(labeled_f, batch_size=batch_size)
+        return labeled_paths, _stack_embeddings(labeled_embs)
 
     def _restore_paths(raw_paths):
         # Rebuild paths relative to labeled folder for cross-platform portability
-        restored = []
-        for p in raw_paths:
-            restored.append(labeled_f / Path(p))
-        return restored
-
-    cache_valid = False
-    if cache_file.exists():
-        cache_mtime = cache_file.stat().st_mtime
-        labeled_files = [f for f in labeled_f.glob("*") if f.is_file()]
-        if labeled_files:
-            newest_labeled = max(f.stat().st_mtime for f in labeled_files)
-            cache_valid = cache_mtime > newest_labeled
+        return [labeled_f.joinpath(p) for p in raw_paths]
 
-    if cache_valid:
+    if _cache_is_fresh(cache_file, labeled_f):
         try:
-            with open(cache_file, "rb") as f:
-                data = pickle.load(f)
-            labeled_paths = _restore_paths(data["paths"])
-            labeled_embs = data["embeddings"]
-            return labeled_paths, labeled_embs
+            labeled_paths = _restore_paths(json.loads(cache_file.with_suffix(".json").read_text()))
+            labeled_embs = np.load(cache_file, mmap_mode="r")
+            if len(labeled_paths) == len(labeled_embs):
+                return labeled_paths, labeled_embs
         except Exception:
             # If cache read fails, fall back to recompute
             pass
 
     labeled_paths, labeled_embs = embed_folder(labeled_f, batch_size=batch_size)
+    labeled_embs = _stack_embeddings(labeled_embs)
 
+    # Write to temporary files that replace the cache afterwards, so readers that memory-mapped the previous cache keep
+    # their (unchanged) file and never see a half-written one
+    json_file = cache_file.with_suffix(".json")
+    tmp_json, tmp_npy = (f.with_name(f".{f.name}.{getrandbits(32):08x}.tmp") for f in (json_file, cache_file))
     try:
         cache_file.parent.mkdir(parents=True, exist_ok=True)
         rel_paths = [p.relative_to(labeled_f).as_posix() for p in labeled_paths]
-        with open(cache_file, "wb") as f:
-            pickle.dump({"paths": rel_paths, "embeddings": labeled_embs}, f)
+        tmp_json.write_text(json.dumps(rel_paths))
+        
+        # Write through a file handle so numpy does not append its own suffix
+        with open(tmp_npy, "wb") as f:
+            np.save(f, labeled_embs)
+        
+        # Replace the matrix last, so it is the newest file
+        os.replace(tmp_json, json_file)
+        os.replace(tmp_npy, cache_file)
     except Exception:
         # Cache write failure should not block main flow
-        pass
+        tmp_json.unlink(missing_ok=True)
+        tmp_npy.unlink(missing_ok=True)
 
     return labeled_paths, labeled_embs
 
 
+def _cache_is_fresh(
+        cache_file: Path,
+        labeled_f: Path,
+) -> bool:
+    """Check that the cache exists and is newer than every file in the labeled folder."""
+    try:
+        cache_mtime = cache_file.stat().st_mtime
+    except OSError:
+        return False
+    
+    # Single directory pass, stop as soon as a labeled file is newer than the cache
+    has_files = False
+    with os.scandir(labeled_f) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            has_files = True
+            if entry.stat().st_mtime >= cache_mtime:
+                return False
+    return has_files
+
+
+def _stack_embeddings(embs: List[np.ndarray]) -> np.ndarray:
+    """Stack the separate embeddings into a single C-contiguous float32 [N, D] matrix."""
+    if len(embs) == 0:
+        return np.zeros((0, 512), dtype=np.float32)
+    return np.ascontiguousarray(np.stack(embs), dtype=np.float32)
+
+
 def recognise(
         path: Path,
         labeled_f: Path,
@@ -78,7 +119,7 @@ def recognise(
 ) -> Set[str]:
     """Recognise all labeled faces present in the image, as specified by the provided path."""
     # Load in the image in which the faces are to be recognised
-    im = load_single(path)
+    im = load_single(path, draft_size=DRAFT_SIZE)
     
     # Detect faces and embed accordingly
     embs = embed(im)
@@ -99,23 +140,34 @@ def recognise(
 def validate_labels(
         labeled_f: Path,
         conflict: Conflict = Conflict.CRASH,
+        batch_size: int = 32,
+        validated: Optional[Set[Path]] = None,
 ) -> None:
     """
     Validate if the labeled data is correct.
     
     :param labeled_f: Folder with labeled data
     :param conflict: How to handle conflict in the data (warn, remove, or crash execution)
+    :param batch_size: Number of images of which the faces are detected at once
+    :param validated: Paths already known to be valid, which are skipped; updated with every newly validated path
     """
-    # Get all image paths to validate
+    # Get all image paths to validate, skip those validated before
     paths = get_im_paths(labeled_f)
+    if validated is not None:
+        paths = [path for path in paths if path not in validated]
     
     # Load in networks used during validation
-    mtcnn, vggface2 = get_networks()
+    mtcnn, _ = get_networks()
     
-    # Start validation
-    for path in paths:
-        im = load_single(path)
-        if not validate_face(im, val_single=True, mtcnn=mtcnn, vggface2=vggface2):
+    # Start validation, batch by batch
+    for i in range(0, len(paths), batch_size):
+        chunk = paths[i:i + batch_size]
+        ims = [load_single(path, draft_size=DRAFT_SIZE) for path in chunk]
+        for path, valid in zip(chunk, validate_faces(ims, val_single=True, mtcnn=mtcnn)):
+            if valid:
+                if validated is not None:
+                    validated.add(path)
+                continue
             if conflict == Conflict.WARN:
                 print(f"Image '{path}' is invalid!")
             elif conflict == Conflict.REMOVE:
@@ -125,6 +177,34 @@ def validate_labels(
                 raise InvalidImageException(path)
 
 
+def _validate_quarantining(
+        labeled_f: Path,
+        batch_size: int = 32,
+) -> None:
+    """Validate the labeled data, moving every invalid image to the 'error_data' folder next to it."""
+    error_dir = labeled_f.parent / "error_data"
+    error_dir.mkdir(exist_ok=True, parents=True)
+
+    # Remember the valid images, so a retry only continues with the remaining ones
+    validated: Set[Path] = set()
+    while True:
+        try:
+            validate_labels(labeled_f, conflict=Conflict.CRASH, batch_size=batch_size, validated=validated)
+            return
+        except InvalidImageException as exc:
+            bad_path = getattr(exc, "path", None)
+            if bad_path is None:
+                raise
+
+            bad_path = Path(bad_path)
+            dest = error_dir / bad_path.name
+            while dest.exists():
+                dest = dest.with_name(f"{dest.stem}_{getrandbits(16)}{dest.suffix}")
+
+            print(f"Invalid image '{bad_path}', moving to '{dest}' and retrying validation...")
+            os.replace(bad_path, dest)
+
+
 def detect_and_export(
         raw_f: Path,
         labeled_f: Path,
@@ -133,8 +213,8 @@ def detect_and_export(
         thr: float = 1.,
         conflict: Conflict = Conflict.CRASH,
         draw_boxes: bool = True,
-    cache_file: Optional[Path] = None,
-    use_cache: bool = True,
+        cache_file: Optional[Path] = None,
+        use_cache: bool = True,
 ) -> None:
     """
     Detect all faces in the images and export them to the correct subfolder.
@@ -146,79 +226,69 @@ def detect_and_export(
     :param thr: Distance threshold
     :param conflict: How to handle conflict in the data (warn, remove, or crash execution)
     :param draw_boxes: Whether to draw face boxes and names on output images
+    :param cache_file: File in which the labeled embeddings are cached, no caching if not provided
+    :param use_cache: Whether to use (and refresh) the embedding cache
     """
     # First, validate that all labels are indeed correct. On crash, move bad images aside and retry.
     if conflict == Conflict.CRASH:
-        error_dir = labeled_f.parent / "error_data"
-        error_dir.mkdir(exist_ok=True, parents=True)
-
-        while True:
-            try:
-                validate_labels(labeled_f, conflict=conflict)
-                break
-            except InvalidImageException as exc:
-                bad_path = getattr(exc, "path", None)
-                if bad_path is None:
-                    raise
-
-                bad_path = Path(bad_path)
-                dest = error_dir / bad_path.name
-                while dest.exists():
-                    dest = dest.with_name(f"{dest.stem}_{getrandbits(16)}{dest.suffix}")
-
-                print(f"Invalid image '{bad_path}', moving to '{dest}' and retrying validation...")
-                move(str(bad_path), dest)
+        _validate_quarantining(labeled_f, batch_size=batch_size)
     else:
-        validate_labels(labeled_f, conflict=conflict)
+        validate_labels(labeled_f, conflict=conflict, batch_size=batch_size)
     
-        # Embed the data (cached when possible)
-        labeled_paths, labeled_embs = _load_or_create_embeddings(
+    # Embed the data (cached when possible)
+    labeled_paths, labeled_embs = _load_or_create_embeddings(
             labeled_f,
             batch_size=batch_size,
             cache_file=cache_file,
             use_cache=use_cache,
-        )
+    )
     
-    # Embed and export by batch, load in images to export first
-    paths = get_im_paths(raw_f)
+    # Fail before any raw image is processed if there is nothing to compare against
+    if len(labeled_embs) == 0:
+        raise NoLabeledFaceException
     
-    # Split the paths into batches
-    chunks: List[Any] = []
-    for i in range(0, len(paths), batch_size):
-        chunks.append((
-            paths[i:i + batch_size],
-            labeled_paths,
+    # Load the networks once, they are shared by all batches
+    mtcnn, vggface2 = get_networks()
+    
+    # Keep the labeled embeddings resident on the networks' device for all batches, in half precision on GPU
+    device = next(vggface2.parameters()).device
+    labeled_embs = as_matrix(
             labeled_embs,
-            write_f,
-            thr,
-            draw_boxes,
-        ))
+            device=device,
+            dtype=torch.float16 if device.type == 'cuda' else torch.float32,
+    )
     
-    # Embed and export each chunk
-    with Pool(cpu_count() - 2) as p:
-        list(tqdm(p.imap(_embed_and_export, chunks), total=len(chunks), desc="Exporting"))
-
-
-def _embed_and_export(
-        args: List[Any],
-) -> None:
-    """Embed the given paths and export the results."""
-    # Unfold the arguments
-    paths, labeled_paths, labeled_embs, write_f, thr, draw_boxes = args
+    # Derive the classes and norms of the labeled faces once, instead of for every batch
+    labeled_classes = [get_class(p) for p in labeled_paths]
+    labeled_norm_sq = squared_norms(labeled_embs)
     
-    # Create the embeddings
-    paths, embs = embed_batch(paths)
+    # Embed and export by batch, paths are streamed so the first batch is dispatched immediately
+    def _chunks(paths: Iterator[Path]) -> Iterator[List[Path]]:
+        while batch := list(islice(paths, batch_size)):
+            yield batch
     
-    # Export the results
-    export(
-            paths=paths,
-            embs=embs,
-            labeled_paths=labeled_paths,
-            labeled_embs=labeled_embs,
-            write_f=write_f,
-            thr=thr,
-            draw_boxes=draw_boxes,
-    )
+    # Images are decoded on the loader threads, embedded on the main thread, and written on the writer threads
+    with ThreadPoolExecutor(max_workers=N_LOADERS) as loader, ThreadPoolExecutor(max_workers=N_WRITERS) as writer:
+        futures = []
+        for batch in tqdm(_chunks(iter_im_paths(raw_f)), desc="Exporting"):
+            batch_paths, embs, boxes = embed_batch(batch, mtcnn=mtcnn, vggface2=vggface2, loader=loader)
+            futures.append(writer.submit(
+                    export,
+                    paths=batch_paths,
+                    embs=embs,
+                    labeled_paths=labeled_paths,
+                    labeled_embs=labeled_embs,
+                    write_f=write_f,
+                    thr=thr,
+                    draw_boxes=draw_boxes,
+                    boxes=boxes,
+                    labeled_classes=labeled_classes,
+                    labeled_norm_sq=labeled_norm_sq,
+            ))
+        
+        # Surface any exception raised during the export
+        for future in futures:
+            future.result()
 
 
 def add_none(
@@ -229,19 +299,24 @@ def add_none(
     # Get the face extraction network
     mtcnn, _ = get_networks()
     
-    # Crop the images
+    # Crop the images into a temporary folder next to the labeled folder, so they can be renamed on the same filesystem
+    # while a crash never leaves them behind as labeled faces
     im = load_single(path)
-    hsh = getrandbits(128)
-    _ = mtcnn(
-            im,
-            save_path=str(Path.cwd() / f'{hsh}.png'),
-    )
-    
-    # Move to labeled_f
-    tmp_images = glob(str(Path.cwd() / f'{hsh}*.png'))
-    n = len(glob(str(labeled_f / 'none_*')))
-    for i, tmp_im in enumerate(tmp_images):
-        move(
-                tmp_im,
-                labeled_f / f'none_{n + i + 1}.png',
+    tmp_f = Path(mkdtemp(dir=labeled_f.parent))
+    try:
+        _ = mtcnn(
+                im,
+                save_path=str(tmp_f / 'face.png'),
         )
+        
+        # Rename to the 'none' class
+        tmp_images = sorted(tmp_f.glob('face*.png'))
+        with os.scandir(labeled_f) as it:
+            n = sum(1 for entry in it if entry.name.startswith('none_'))
+        for i, tmp_im in enumerate(tmp_images):
+            os.replace(
+                    tmp_im,
+                    labeled_f / f'none_{n + i + 1}.png',
+            )
+    finally:
+        rmtree(tmp_f, ignore_errors=True)
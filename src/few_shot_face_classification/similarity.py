@@ -1,19 +1,89 @@
 """Check similarities between embeddings and operate accordingly."""
+from concurrent.futures import Executor
+from functools import lru_cache
 from pathlib import Path
 from shutil import copy
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
-from PIL import Image
-from sklearn.metrics.pairwise import euclidean_distances
+import torch
+from PIL import Image, ImageDraw, ImageFont
 
+from few_shot_face_classification.exceptions import NoLabeledFaceException
 from few_shot_face_classification.utils import get_class
 
+# SimSIMD (optional) provides SIMD distance kernels without BLAS overhead, used for small query batches
+try:
+    import simsimd
+    _HAVE_SIMSIMD = True
+except ImportError:
+    _HAVE_SIMSIMD = False
+
+# Numba (optional) provides a fused distance + nearest-neighbour kernel, used for small batches without SimSIMD
+try:
+    from few_shot_face_classification.similarity_numba import nearest as _nearest_numba
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+
+# Maximum number of query embeddings for which a dedicated kernel is preferred over the matrix multiplication
+KERNEL_MAX_QUERIES = 16
+
+# Labeled matrices larger than this (in bytes) are multiplied in tiles of TILE_ROWS rows, to stay in the L2 cache
+TILE_BYTES = 256 * 1024
+TILE_ROWS = 1024
+
+# Common font paths (supporting Chinese characters) on different platforms, tried in order
+FONT_PATHS = [
+    # Linux fonts (common locations)
+    "/usr/share/fonts/truetype/NotoSansCJKsc-VF.otf",
+    "/usr/share/fonts/truetype/SourceHanSansCN-Normal.otf",
+    "/usr/share/fonts/truetype/SourceHanSansCN-Regular.otf",
+    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    # Windows fonts
+    "C:\\Windows\\Fonts\\simhei.ttf",  # SimHei (黑体)
+    "C:\\Windows\\Fonts\\simsun.ttc",  # SimSun (宋体)
+    "C:\\Windows\\Fonts\\msyh.ttc",    # Microsoft YaHei (微软雅黑)
+    # macOS fonts
+    "/System/Library/Fonts/PingFang.ttc",
+    "/Library/Fonts/Arial Unicode.ttf",
+]
+
+# Resolved fonts per font size
+_FONT_CACHE: Dict[int, Any] = {}
+
+# Canvas used to measure text, independent of the image that is drawn on
+_DUMMY_DRAW = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+# Embeddings are either a list of vectors, a stacked [N, D] array, or a (device-resident) [N, D] tensor
+Embeddings = Union[List[np.ndarray], np.ndarray, torch.Tensor]
+
+
+def as_matrix(
+        embs: Embeddings,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+) -> torch.Tensor:
+    """Convert the embeddings to a single [N, D] tensor, without copying when already in the right format."""
+    if not isinstance(embs, torch.Tensor):
+        embs = torch.from_numpy(np.asarray(embs, dtype=np.float32))
+    return embs.to(device=device, dtype=dtype)
+
+
+def squared_norms(labeled_embs: Embeddings) -> torch.Tensor:
+    """Get the squared L2-norm of every labeled embedding, to be computed once and reused by get_classes_sq."""
+    labeled = as_matrix(labeled_embs)
+    return labeled.float().pow(2).sum(dim=1)
+
 
 def get_classes(
-        embs: List[np.ndarray],
+        embs: Embeddings,
         labeled_paths: List[Path],
-        labeled_embs: List[np.ndarray],
+        labeled_embs: Embeddings,
         thr: float = 1.,
 ) -> List[Optional[str]]:
     """
@@ -24,31 +94,114 @@ def get_classes(
     :param labeled_embs: Embeddings of the labeled faces
     :param thr: Distance threshold, return None if no distance falls below it
     """
-    # Get all classes that belong to the labeled embeddings
-    labeled_classes = [get_class(p) for p in labeled_paths]
-    
-    # Calculate the distance between embeddings
-    dist = euclidean_distances(embs, labeled_embs)
-    
-    # Derive the best suiting class
-    classes = []
-    for d in dist:
-        classes.append(
-                labeled_classes[np.where(d == min(d))[0][0]]
-                if min(d) <= thr
-                else None
-        )
-    return classes
+    if len(embs) == 0:
+        return []
+    return get_classes_sq(
+            embs=embs,
+            labeled_classes=[get_class(p) for p in labeled_paths],
+            labeled_embs=labeled_embs,
+            labeled_norm_sq=squared_norms(labeled_embs),
+            thr_sq=thr * thr,
+    )
+
+
+def get_classes_sq(
+        embs: Embeddings,
+        labeled_classes: List[Optional[str]],
+        labeled_embs: Embeddings,
+        labeled_norm_sq: torch.Tensor,
+        thr_sq: float = 1.,
+) -> List[Optional[str]]:
+    """
+    Extract the best fitting classes using squared distances, None if no good match.
+    
+    :param embs: Embeddings to classify
+    :param labeled_classes: Classes of the labeled embeddings
+    :param labeled_embs: Embeddings of the labeled faces
+    :param labeled_norm_sq: Squared norms of the labeled embeddings, as given by squared_norms
+    :param thr_sq: Squared distance threshold, return None if no squared distance falls below it
+    """
+    # Nothing to classify (e.g. no faces detected)
+    if len(embs) == 0:
+        return []
+    
+    # Fail clearly when there is nothing to compare against, instead of deep inside the distance computation
+    labeled = as_matrix(labeled_embs)
+    if len(labeled) == 0:
+        raise NoLabeledFaceException
+    query = as_matrix(embs, device=labeled.device, dtype=labeled.dtype)
+    
+    # Few queries on CPU (e.g. the faces of a single frame) go through a dedicated kernel: SimSIMD if available,
+    # otherwise the fused Numba kernel
+    use_kernel = (
+            len(query) < KERNEL_MAX_QUERIES
+            and labeled.device.type == 'cpu'
+            and labeled.dtype == torch.float32
+    )
+    if use_kernel and _HAVE_SIMSIMD:
+        dist_sq = np.asarray(simsimd.cdist(
+                query.contiguous().numpy(),
+                labeled.contiguous().numpy(),
+                metric='sqeuclidean',
+        ), dtype=np.float32)
+        best_sq, idx = dist_sq.min(axis=1), dist_sq.argmin(axis=1)
+    elif use_kernel and _HAVE_NUMBA:
+        best_sq, idx = _nearest_numba(query.contiguous().numpy(), labeled.contiguous().numpy())
+    
+    # Otherwise, go through the matrix multiplication
+    else:
+        best_sq, idx = (x.cpu().numpy() for x in _nearest_matmul(query, labeled, labeled_norm_sq))
+    
+    # Derive the best suiting class, None for those without a labeled face within the threshold (no square root
+    # is needed to threshold)
+    classes = np.array(labeled_classes, dtype=object)[idx]
+    classes[best_sq > thr_sq] = None
+    return classes.tolist()
+
+
+def _nearest_matmul(
+        query: torch.Tensor,
+        labeled: torch.Tensor,
+        labeled_norm_sq: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Get the squared distance to, and index of, the nearest labeled embedding for every query embedding.
+    
+    The squared distance ||q - l||^2 is expanded into ||q||^2 + ||l||^2 - 2 q.l, so the distances come from a matrix
+    multiplication on the device (and in the precision) of the labeled embeddings. Large labeled matrices are
+    processed in tiles, keeping a running minimum, so neither the tile nor the partial distances leave the cache.
+    """
+    labeled_norm_sq = labeled_norm_sq.to(labeled.device)
+    query_norm_sq = query.float().pow(2).sum(dim=1, keepdim=True)
+    tile = TILE_ROWS if labeled.element_size() * labeled.nelement() > TILE_BYTES else max(len(labeled), 1)
+    
+    best_sq, idx = None, None
+    for j in range(0, len(labeled), tile):
+        dist_sq = query_norm_sq + labeled_norm_sq[j:j + tile] - 2. * (query @ labeled[j:j + tile].T).float()
+        tile_best_sq, tile_idx = dist_sq.min(dim=1)
+        if best_sq is None:
+            best_sq, idx = tile_best_sq, tile_idx
+        else:
+            better = tile_best_sq < best_sq
+            best_sq = torch.where(better, tile_best_sq, best_sq)
+            idx = torch.where(better, tile_idx + j, idx)
+    return best_sq, idx
 
 
 def export(
         paths: List[Path],
-        embs: List[np.ndarray],
+        embs: Embeddings,
         labeled_paths: List[Path],
-        labeled_embs: List[np.ndarray],
+        labeled_embs: Embeddings,
         write_f: Path,
         thr: float = 1.,
         draw_boxes: bool = True,
+        mtcnn: Optional[Any] = None,
+        vggface2: Optional[Any] = None,
+        labeled_classes: Optional[List[Optional[str]]] = None,
+        labeled_norm_sq: Optional[torch.Tensor] = None,
+        boxes: Optional[List[np.ndarray]] = None,
+        executor: Optional[Executor] = None,
 ) -> None:
     """
     Export (copy) all images to their corresponding class (recognised person).
@@ -61,73 +214,151 @@ def export(
     :param write_f: Folder to write results to (in corresponding subfolders)
     :param thr: Distance threshold
     :param draw_boxes: Whether to draw face boxes and names on the output images
+    :param mtcnn: MTCNN network for face extraction, only used when drawing boxes that are not provided
+    :param vggface2: VGGFace2 network to embed the face, only used when drawing boxes that are not provided
+    :param labeled_classes: Classes of the labeled faces, derived from labeled_paths if not provided
+    :param labeled_norm_sq: Squared norms of the labeled embeddings, computed if not provided
+    :param boxes: Bounding boxes of the faces (aligned with embs), the faces are detected again if not provided
+    :param executor: Executor on which the images are drawn and written, written in-line if not provided
     """
+    # Derive everything needed from the labeled faces once, if not yet done by the caller
+    if labeled_classes is None:
+        labeled_classes = [get_class(p) for p in labeled_paths]
+    if labeled_norm_sq is None:
+        labeled_norm_sq = squared_norms(labeled_embs)
+    
     # Derive all the labeled classes
-    classes = get_classes(
+    classes = get_classes_sq(
             embs=embs,
-            labeled_paths=labeled_paths,
+            labeled_classes=labeled_classes,
             labeled_embs=labeled_embs,
-            thr=thr,
+            labeled_norm_sq=labeled_norm_sq,
+            thr_sq=thr * thr,
     )
     
-    # Import MTCNN for face detection if drawing boxes
-    if draw_boxes:
-        from few_shot_face_classification.embed import get_networks, embed
+    # Group the provided boxes and classes of the faces per image, so they are drawn without detecting them again
+    faces_per_path: Dict[Path, Tuple[List[np.ndarray], List[Optional[str]]]] = {}
+    if draw_boxes and boxes is not None:
+        for path, box, cls in zip(paths, boxes, classes):
+            face_boxes, face_classes = faces_per_path.setdefault(path, ([], []))
+            face_boxes.append(box)
+            face_classes.append(cls)
+    
+    # Every (class, image) pair is exported once, an image with multiple faces of the same class is not written twice
+    to_export = [(cls, path) for cls, path in dict.fromkeys(zip(classes, paths)) if cls is not None]
+    
+    # Detect the faces that are not provided upstream, serially since the networks are not shared between threads
+    if draw_boxes and boxes is None:
+        faces_per_path = _detect_faces_per_path(
+                paths=list(dict.fromkeys(path for _, path in to_export)),
+                mtcnn=mtcnn,
+                vggface2=vggface2,
+                labeled_classes=labeled_classes,
+                labeled_embs=labeled_embs,
+                labeled_norm_sq=labeled_norm_sq,
+                thr_sq=thr * thr,
+        )
+    
+    def _handle(cls: str, path: Path) -> None:
+        face_boxes, face_names = faces_per_path.get(path, ([], []))
+        _export_single(path, write_f / cls, face_boxes if draw_boxes else [], face_names)
+    
+    # Assign images to correct class, the file I/O and drawing run on the executor if provided
+    if executor is None:
+        for cls, path in to_export:
+            _handle(cls, path)
+    else:
+        list(executor.map(lambda t: _handle(*t), to_export))
+
+
+def _detect_faces_per_path(
+        paths: List[Path],
+        mtcnn: Optional[Any],
+        vggface2: Optional[Any],
+        labeled_classes: List[Optional[str]],
+        labeled_embs: Embeddings,
+        labeled_norm_sq: torch.Tensor,
+        thr_sq: float,
+) -> Dict[Path, Tuple[List[np.ndarray], List[Optional[str]]]]:
+    """Detect and classify the faces of every image, images for which this fails are left out."""
+    from few_shot_face_classification.embed import get_networks, embed_with_boxes
+    if mtcnn is None or vggface2 is None:
         mtcnn, vggface2 = get_networks()
     
-    # Assign images to correct class
-    for cls, path in zip(classes, paths):
-        # Ignore when no class is recognised
-        if cls is None:
+    faces_per_path = {}
+    for path in paths:
+        try:
+            with Image.open(path) as im:
+                face_boxes, face_embs = embed_with_boxes(im, mtcnn=mtcnn, vggface2=vggface2)
+            faces_per_path[path] = (face_boxes, get_classes_sq(
+                    embs=face_embs,
+                    labeled_classes=labeled_classes,
+                    labeled_embs=labeled_embs,
+                    labeled_norm_sq=labeled_norm_sq,
+                    thr_sq=thr_sq,
+            ))
+        except Exception as e:
+            # If any error occurs during detection, the original is copied
+            print(f"Warning: Could not draw boxes on {path}: {e}")
+    return faces_per_path
+
+
+def _export_single(
+        path: Path,
+        class_f: Path,
+        boxes: List[np.ndarray],
+        names: List[Optional[str]],
+) -> None:
+    """Write the image to its class folder, with the face boxes drawn on it if any are given (copied otherwise)."""
+    # Ensure class-folder exists
+    class_f.mkdir(parents=True, exist_ok=True)
+    output_path = class_f / path.name
+    
+    # Just copy if no boxes are drawn
+    if len(boxes) == 0:
+        copy(path, output_path)
+        return
+    
+    try:
+        # Draw the boxes, with "Unknown" for the unrecognised faces, and save the image
+        with Image.open(path) as im:
+            names = [name if name else "Unknown" for name in names]
+            _draw_faces_pil(im, boxes, names).save(output_path)
+    except Exception as e:
+        # If any error occurs during processing, just copy the original
+        print(f"Warning: Could not draw boxes on {path}: {e}")
+        copy(path, output_path)
+
+
+def _get_font(size: int = 20):
+    """Get the first available font that supports Chinese characters, cached per size after the first lookup."""
+    if size in _FONT_CACHE:
+        return _FONT_CACHE[size]
+    
+    font = None
+    for font_path in FONT_PATHS:
+        try:
+            font = ImageFont.truetype(font_path, size)
+            break
+        except Exception:
             continue
-        
-        # Ensure class-folder exists
-        (write_f / cls).mkdir(parents=True, exist_ok=True)
-        output_path = write_f / f"{cls}/{path.name}"
-        
-        # If drawing boxes is enabled, process the image
-        if draw_boxes:
-            try:
-                # Load image using PIL for consistency with the rest of the code
-                im = Image.open(path)
-                
-                # Detect faces and get their embeddings
-                batch_boxes, _ = mtcnn.detect(im)
-                
-                # Only process if faces were detected
-                if batch_boxes is not None and len(batch_boxes) > 0:
-                    # Get embeddings for all detected faces
-                    face_embs = embed(im, mtcnn=mtcnn, vggface2=vggface2)
-                    
-                    # Identify each face separately
-                    face_names = get_classes(
-                        embs=face_embs,
-                        labeled_paths=labeled_paths,
-                        labeled_embs=labeled_embs,
-                        thr=thr,
-                    )
-                    
-                    # Replace None with "Unknown"
-                    face_names = [name if name else "Unknown" for name in face_names]
-                    
-                    # Draw boxes on the image
-                    img_with_boxes = _draw_faces_on_image(im, batch_boxes, face_names)
-                    
-                    # Save the image with boxes
-                    img_with_boxes.save(output_path)
-                else:
-                    # No faces detected, just copy
-                    copy(path, output_path)
-            except Exception as e:
-                # If any error occurs during processing, just copy the original
-                print(f"Warning: Could not draw boxes on {path}: {e}")
-                copy(path, output_path)
-        else:
-            # Original behavior: just copy
-            copy(path, output_path)
+    
+    if font is None:
+        # Fallback to default font if no Chinese font found
+        font = ImageFont.load_default()
+    _FONT_CACHE[size] = font
+    return font
+
+
+@lru_cache(maxsize=256)
+def _text_size(text: str, font_size: int) -> Tuple[int, int]:
+    """Get the (width, height) of the text in the font of the given size, cached since the same names recur."""
+    bbox = _DUMMY_DRAW.textbbox((0, 0), text, font=_get_font(font_size))
+    return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
 
-def _draw_faces_on_image(
-        image,
+def _draw_faces_pil(
+        image: Image.Image,
         boxes: np.ndarray,
         names: List[str],
         box_color: tuple = (0, 255, 0),
@@ -138,7 +369,7 @@ def _draw_faces_on_image(
     Draw face boxes and names on the image.
     支持中文文本显示，保持原始色彩不变。
     
-    :param image: PIL Image or numpy array
+    :param image: PIL Image to draw on (a copy is returned, the image itself is not modified)
     :param boxes: Face bounding boxes from MTCNN [[x1, y1, x2, y2], ...]
     :param names: List of names corresponding to each face
     :param box_color: BGR color tuple for boxes (default green)
@@ -146,69 +377,22 @@ def _draw_faces_on_image(
     :param text_bg_color: BGR color tuple for text background (default green)
     :return: PIL Image with drawn boxes and names
     """
-    from PIL import Image, ImageDraw, ImageFont
-    
-    # Ensure image is PIL Image (not numpy array)
-    if isinstance(image, np.ndarray):
-        # Check if it's BGR or RGB
-        if len(image.shape) == 3 and image.shape[2] == 3:
-            # Assume it's RGB from PIL (correct format)
-            image = Image.fromarray(image, mode='RGB')
-        else:
-            image = Image.fromarray(image)
-    else:
-        # Already PIL Image, just make a copy to avoid modifying original
-        image = image.copy()
-    
-    # Create a copy to draw on
+    # Draw on a copy, keeping the original unmodified
     result = image.copy()
     draw = ImageDraw.Draw(result)
     
-    # Try to load a font that supports Chinese characters
+    # Load a font that supports Chinese characters (resolved once per size)
     font_size = 20
-    try:
-        # Try common Chinese font paths on different platforms
-        font_paths = [
-            # Linux fonts (common locations)
-            "/usr/share/fonts/truetype/NotoSansCJKsc-VF.otf",
-            "/usr/share/fonts/truetype/SourceHanSansCN-Normal.otf",
-            "/usr/share/fonts/truetype/SourceHanSansCN-Regular.otf",
-            "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
-            "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
-            "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-            "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
-            # Windows fonts
-            "C:\\Windows\\Fonts\\simhei.ttf",  # SimHei (黑体)
-            "C:\\Windows\\Fonts\\simsun.ttc",  # SimSun (宋体)
-            "C:\\Windows\\Fonts\\msyh.ttc",    # Microsoft YaHei (微软雅黑)
-            # macOS fonts
-            "/System/Library/Fonts/PingFang.ttc",
-            "/Library/Fonts/Arial Unicode.ttf",
-        ]
-        font = None
-        for font_path in font_paths:
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-                break
-            except:
-                continue
-        
-        if font is None:
-            # Fallback to default font if no Chinese font found
-            font = ImageFont.load_default()
-    except:
-        font = ImageFont.load_default()
+    font = _get_font(font_size)
     
     # Convert BGR colors to RGB for PIL
     box_color_rgb = (box_color[2], box_color[1], box_color[0])
     text_color_rgb = (text_color[2], text_color[1], text_color[0])
     text_bg_color_rgb = (text_bg_color[2], text_bg_color[1], text_bg_color[0])
     
-    # Draw boxes and text
-    for box, name in zip(boxes, names):
-        x1, y1, x2, y2 = [int(v) for v in box]
-        
+    # Draw boxes and text, with the box coordinates converted to integers at once
+    boxes_i = np.asarray(boxes, dtype=np.int32).tolist()
+    for (x1, y1, x2, y2), name in zip(boxes_i, names):
         # Draw bounding box
         draw.rectangle([x1, y1, x2, y2], outline=box_color_rgb, width=2)
         
@@ -217,9 +401,7 @@ def _draw_faces_on_image(
         
         # Get text bounding box for PIL
         try:
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
+            text_width, text_height = _text_size(text, font_size)
         except:
             text_width = len(text) * 10
             text_height = font_size
@@ -243,3 +425,50 @@ def _draw_faces_on_image(
         )
     
     return result
+
+
+def _draw_faces_bgr(
+        frame_bgr: np.ndarray,
+        boxes: np.ndarray,
+        names: List[str],
+        box_color: tuple = (0, 255, 0),
+        text_color: tuple = (0, 0, 0),
+        text_bg_color: tuple = (0, 255, 0),
+) -> np.ndarray:
+    """
+    Draw face boxes and names directly on an OpenCV frame (in place), same layout as _draw_faces_pil.
+    Only supports ASCII names, use _draw_faces_pil for other (e.g. Chinese) names.
+    
+    :param frame_bgr: OpenCV BGR frame to draw on
+    :param boxes: Face bounding boxes from MTCNN [[x1, y1, x2, y2], ...]
+    :param names: List of names corresponding to each face
+    :param box_color: BGR color tuple for boxes (default green)
+    :param text_color: BGR color tuple for text (default black)
+    :param text_bg_color: BGR color tuple for text background (default green)
+    :return: The same frame, with drawn boxes and names
+    """
+    import cv2
+    
+    # Convert the box coordinates to integers at once
+    boxes_i = np.asarray(boxes, dtype=np.int32).tolist()
+    for (x1, y1, x2, y2), name in zip(boxes_i, names):
+        # Draw bounding box
+        cv2.rectangle(frame_bgr, (x1, y1), (x2, y2), box_color, 2)
+        
+        # Draw text background (above the face box) and text
+        text = str(name) if name else "Unknown"
+        (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)
+        text_y = max(y1 - text_height - 10, 5)
+        cv2.rectangle(frame_bgr, (x1, text_y), (x1 + text_width + 10, text_y + text_height + 10), text_bg_color, -1)
+        cv2.putText(
+            frame_bgr,
+            text,
+            (x1 + 5, text_y + text_height + 5),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            text_color,
+            1,
+            cv2.LINE_AA,
+        )
+    
+    return frame_bgr
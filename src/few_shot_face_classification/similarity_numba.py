@@ -0,0 +1,35 @@
+"""Fused distance and nearest-neighbour kernel, compiled with Numba (optional dependency)."""
+from typing import Tuple
+
+import numpy as np
+from numba import njit
+
+
+@njit(fastmath=True, cache=True)
+def nearest(
+        q: np.ndarray,
+        labeled: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the nearest labeled embedding of every query embedding, without materialising the distance matrix.
+    
+    Runs single-threaded: it only serves small query batches, and is called concurrently from the export threads.
+    
+    :param q: Query embeddings of shape (N, D)
+    :param labeled: Labeled embeddings of shape (M, D)
+    :return: Squared distance to, and index of, the nearest labeled embedding for every query
+    """
+    best_sq = np.empty(q.shape[0], dtype=np.float32)
+    best_idx = np.empty(q.shape[0], dtype=np.int64)
+    for i in range(q.shape[0]):
+        best, idx = 1e30, -1
+        for j in range(labeled.shape[0]):
+            s = 0.
+            for k in range(q.shape[1]):
+                d = q[i, k] - labeled[j, k]
+                s += d * d
+            if s < best:
+                best, idx = s, j
+        best_sq[i] = best
+        best_idx[i] = idx
+    return best_sq, best_idx
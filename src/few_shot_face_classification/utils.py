@@ -6,6 +6,9 @@ from typing import Optional
 # All supported image suffixes
 IMG_SUFFIX = {'.png', '.jpg', '.jpeg'}
 
+# Minimal size at which (JPEG) images are decoded when only used for face detection and embedding
+DRAFT_SIZE = (1280, 1280)
+
 
 def get_class(p: Path) -> Optional[str]:
     """Get the class-name of the given path."""
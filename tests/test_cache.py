@@ -0,0 +1,83 @@
+"""Tests for the caching of the labeled embeddings."""
+import json
+import os
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pytest
+
+from few_shot_face_classification import main
+
+
+@pytest.fixture
+def labeled_f(tmp_path: Path) -> Path:
+    """Folder with labeled faces, all older than any cache written during the test."""
+    folder = tmp_path / "labeled"
+    folder.mkdir()
+    for name in ("alice_1.png", "alice_2.png", "bob_1.png"):
+        (folder / name).write_bytes(b"")
+        os.utime(folder / name, (0, 0))
+    return folder
+
+
+@pytest.fixture
+def embedded(monkeypatch: pytest.MonkeyPatch) -> List[Path]:
+    """Replace the embedding of the labeled folder, return the folders that got embedded."""
+    folders: List[Path] = []
+    
+    def _embed_folder(folder: Path, batch_size: int = 32):
+        folders.append(folder)
+        paths = sorted(folder.glob("*.png"))
+        return paths, [np.full(512, i, dtype=np.float32) for i in range(len(paths))]
+    
+    monkeypatch.setattr(main, "embed_folder", _embed_folder)
+    return folders
+
+
+def test_cache_reused(labeled_f: Path, embedded: List[Path], tmp_path: Path) -> None:
+    """A second run loads the embeddings from the cache, without embedding again."""
+    cache_file = tmp_path / "cache" / "embeddings.npy"
+    paths_1, embs_1 = main._load_or_create_embeddings(labeled_f, cache_file=cache_file)
+    paths_2, embs_2 = main._load_or_create_embeddings(labeled_f, cache_file=cache_file)
+    
+    assert len(embedded) == 1
+    assert paths_1 == paths_2
+    np.testing.assert_array_equal(embs_1, embs_2)
+    assert embs_2.dtype == np.float32 and embs_2.shape == (3, 512)
+
+
+def test_cache_invalidated_by_labeled_change(labeled_f: Path, embedded: List[Path], tmp_path: Path) -> None:
+    """Touching a labeled file makes the cache stale."""
+    cache_file = tmp_path / "embeddings.npy"
+    main._load_or_create_embeddings(labeled_f, cache_file=cache_file)
+    
+    future = time.time() + 10
+    os.utime(labeled_f / "bob_1.png", (future, future))
+    main._load_or_create_embeddings(labeled_f, cache_file=cache_file)
+    
+    assert len(embedded) == 2
+
+
+def test_cache_recomputed_on_length_mismatch(labeled_f: Path, embedded: List[Path], tmp_path: Path) -> None:
+    """A path list that does not match the cached matrix triggers a recompute."""
+    cache_file = tmp_path / "embeddings.npy"
+    main._load_or_create_embeddings(labeled_f, cache_file=cache_file)
+    
+    cache_file.with_suffix(".json").write_text(json.dumps(["alice_1.png"]))
+    os.utime(cache_file, None)
+    paths, embs = main._load_or_create_embeddings(labeled_f, cache_file=cache_file)
+    
+    assert len(embedded) == 2
+    assert len(paths) == len(embs) == 3
+
+
+def test_no_cache(labeled_f: Path, embedded: List[Path], tmp_path: Path) -> None:
+    """Without caching, every run embeds the labeled folder."""
+    cache_file = tmp_path / "embeddings.npy"
+    main._load_or_create_embeddings(labeled_f, cache_file=cache_file, use_cache=False)
+    main._load_or_create_embeddings(labeled_f, cache_file=cache_file, use_cache=False)
+    
+    assert len(embedded) == 2
+    assert not cache_file.exists()
@@ -1,13 +1,20 @@
 import argparse
-import pickle
 from pathlib import Path
+from typing import List, Optional
 
 import cv2
 import numpy as np
 from PIL import Image
 
-from src.few_shot_face_classification.embed import embed, embed_folder, get_networks
-from src.few_shot_face_classification.similarity import get_classes, _draw_faces_on_image
+from few_shot_face_classification.embed import embed_faces, get_networks
+from few_shot_face_classification.main import _load_or_create_embeddings
+from few_shot_face_classification.similarity import (
+    get_classes_sq,
+    squared_norms,
+    _draw_faces_bgr,
+    _draw_faces_pil,
+)
+from few_shot_face_classification.utils import get_class
 
 
 def parse_args() -> argparse.Namespace:
@@ -18,110 +25,126 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--width", type=int, default=0, help="Optional camera width")
     parser.add_argument("--height", type=int, default=0, help="Optional camera height")
     parser.add_argument("--batch_size", type=int, default=32, help="Batch size for loading labeled embeddings")
-    parser.add_argument("--cache", type=Path, default=Path("data/embeddings_cache.pkl"), help="Cache file for embeddings")
+    parser.add_argument("--cache", type=Path, default=Path("data/embeddings_cache.npy"), help="Cache file for embeddings")
     parser.add_argument("--no-cache", action="store_true", help="Force re-processing without using cache")
+    parser.add_argument("--compile", action="store_true", help="Compile the embedding network (slow start, faster frames)")
+    parser.add_argument("--fp16", action="store_true", help="Run the networks in half precision (GPU only)")
+    parser.add_argument("--pil-draw", action="store_true", help="Always draw with PIL (slower, supports any name)")
+    parser.add_argument("--detect-scale", type=float, default=0.5, help="Scale at which frames are searched for faces")
+    parser.add_argument("--detect-every", type=int, default=5, help="Detect faces every N frames, track them in between (needs opencv-contrib, else every frame)")
     return parser.parse_args()
 
 
-def load_or_create_embeddings(labeled_folder: Path, cache_file: Path, batch_size: int, use_cache: bool = True):
-    """Load embeddings from cache or create new ones."""
-    def _restore_paths(raw_paths):
-        # Rebuild paths relative to current labeled folder to stay cross-platform
-        restored = []
-        for p in raw_paths:
-            # Accept stored as str or Path-like; treat as relative path
-            rel = Path(p)
-            restored.append(labeled_folder / rel)
-        return restored
-
-    # Check if cache exists and is newer than labeled folder
-    cache_valid = False
-    if use_cache and cache_file.exists():
-        cache_mtime = cache_file.stat().st_mtime
-        # Check if any file in labeled folder is newer than cache
-        labeled_files = list(labeled_folder.glob("*"))
-        if labeled_files:
-            newest_labeled = max(f.stat().st_mtime for f in labeled_files if f.is_file())
-            cache_valid = cache_mtime > newest_labeled
-        
-    if cache_valid:
-        print(f"Loading embeddings from cache: {cache_file}")
-        try:
-            with open(cache_file, "rb") as f:
-                data = pickle.load(f)
-            labeled_paths = _restore_paths(data["paths"])
-            labeled_embs = data["embeddings"]
-            print(f"Loaded {len(labeled_embs)} cached embeddings")
-            return labeled_paths, labeled_embs
-        except Exception as e:
-            print(f"Failed to load cache: {e}")
-            print("Re-processing labeled images...")
-    
-    # Process labeled images
-    print("Processing labeled images...")
-    labeled_paths, labeled_embs = embed_folder(labeled_folder, batch_size=batch_size)
-    
-    # Save to cache
-    try:
-        cache_file.parent.mkdir(parents=True, exist_ok=True)
-        rel_paths = [p.relative_to(labeled_folder).as_posix() for p in labeled_paths]
-        with open(cache_file, "wb") as f:
-            pickle.dump({"paths": rel_paths, "embeddings": labeled_embs}, f)
-        print(f"Saved embeddings to cache: {cache_file}")
-    except Exception as e:
-        print(f"Warning: Failed to save cache: {e}")
-    
-    return labeled_paths, labeled_embs
+def _open_camera(camera: int, width: int = 0, height: int = 0) -> cv2.VideoCapture:
+    """Open the video source, at the requested resolution if given."""
+    cap = cv2.VideoCapture(camera)
+    if width:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    if height:
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+
+    if not cap.isOpened():
+        raise RuntimeError("Could not open video source")
+    return cap
+
+
+def _create_trackers(frame: np.ndarray, boxes: np.ndarray):
+    """Create a KCF tracker for every face box, None if OpenCV is built without the (contrib) trackers."""
+    legacy = getattr(cv2, "legacy", None)
+    if legacy is None or not hasattr(legacy, "MultiTracker_create"):
+        return None
+    trackers = legacy.MultiTracker_create()
+    for x1, y1, x2, y2 in boxes:
+        trackers.add(legacy.TrackerKCF_create(), frame, (float(x1), float(y1), float(x2 - x1), float(y2 - y1)))
+    return trackers
+
+
+def _track_faces(trackers, frame: np.ndarray) -> Optional[np.ndarray]:
+    """Follow the faces to the new frame, None if the trackers lost all of them."""
+    ok, tracked = trackers.update(frame)
+    if not ok or len(tracked) == 0:
+        return None
+    return np.array([[x, y, x + w, y + h] for x, y, w, h in tracked], dtype=np.float32)
+
+
+def _detect_faces(mtcnn, frame: np.ndarray, pil_im: Image.Image, detect_scale: float) -> Optional[np.ndarray]:
+    """Detect the faces in the frame, on a downscaled copy since detection cost grows with the pixel count."""
+    if detect_scale == 1.0:
+        boxes, _ = mtcnn.detect(pil_im)
+        return boxes
+
+    small = cv2.resize(frame, None, fx=detect_scale, fy=detect_scale, interpolation=cv2.INTER_AREA)
+    boxes, _ = mtcnn.detect(Image.fromarray(small[..., ::-1]))
+    if boxes is None:
+        return None
+
+    # Scale the boxes back up to the full-resolution frame
+    scale_x, scale_y = frame.shape[1] / small.shape[1], frame.shape[0] / small.shape[0]
+    return boxes * np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+
+
+def _draw_faces(frame: np.ndarray, pil_im: Image.Image, boxes: np.ndarray, names: List[str], pil_draw: bool) -> np.ndarray:
+    """Draw boxes and names directly on the BGR frame, fall back to PIL for non-ASCII (e.g. Chinese) names."""
+    if pil_draw or not all(n.isascii() for n in names):
+        annotated = _draw_faces_pil(pil_im, boxes, names)
+        return cv2.cvtColor(np.array(annotated), cv2.COLOR_RGB2BGR)
+    return _draw_faces_bgr(frame, boxes, names)
 
 
 def main() -> None:
     args = parse_args()
 
     # Load or create labeled embeddings with caching
-    labeled_paths, labeled_embs = load_or_create_embeddings(
-        args.labeled, 
-        args.cache, 
-        args.batch_size, 
-        use_cache=not args.no_cache
+    labeled_paths, labeled_embs = _load_or_create_embeddings(
+        args.labeled,
+        batch_size=args.batch_size,
+        cache_file=args.cache,
+        use_cache=not args.no_cache,
     )
     print(f"Ready with {len(labeled_embs)} labeled faces from {args.labeled}")
 
-    # Load networks (auto-select GPU if available)
-    mtcnn, vggface2 = get_networks()
-
-    cap = cv2.VideoCapture(args.camera)
-    if args.width:
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, args.width)
-    if args.height:
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, args.height)
+    # Everything derived from the labeled faces is computed once, not per frame
+    labeled_classes = [get_class(p) for p in labeled_paths]
+    labeled_norm_sq = squared_norms(labeled_embs)
+    thr_sq = args.threshold ** 2
 
-    if not cap.isOpened():
-        raise RuntimeError("Could not open video source")
+    # Load networks (auto-select GPU if available)
+    mtcnn, vggface2 = get_networks(compiled=args.compile, half=args.fp16)
 
+    cap = _open_camera(args.camera, args.width, args.height)
     print("Press 'q' or 'ESC' to quit (make sure the video window is focused)")
 
+    frame_idx = 0
+    trackers = None
+    boxes, names = None, []
     while True:
         ret, frame = cap.read()
         if not ret:
             break
 
-        # Convert to PIL for the existing pipeline (keeps color correctness)
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pil_im = Image.fromarray(rgb)
-
-        # Detect faces and get bounding boxes
-        boxes, _ = mtcnn.detect(pil_im)
-        
-        # Compute embeddings for detected faces
-        embs = embed(pil_im, mtcnn=mtcnn, vggface2=vggface2)
+        # Convert to PIL for the existing pipeline, through a channel-reversed (RGB) view instead of a conversion
+        pil_im = Image.fromarray(frame[..., ::-1])
+
+        # In between detections, follow the last faces with the trackers; detect on every frame without trackers,
+        # and as soon as they lose all targets
+        tracked = None
+        if trackers is not None and frame_idx % max(args.detect_every, 1) != 0:
+            tracked = _track_faces(trackers, frame)
+
+        if tracked is not None:
+            boxes = tracked
+        else:
+            boxes, names, trackers = _detect_faces(mtcnn, frame, pil_im, args.detect_scale), [], None
+            if boxes is not None and len(boxes) > 0:
+                # Compute embeddings for detected faces, cropped from the full-resolution frame
+                embs = embed_faces(pil_im, boxes, mtcnn=mtcnn, vggface2=vggface2)
+                names = get_classes_sq(embs, labeled_classes, labeled_embs, labeled_norm_sq, thr_sq)
+                names = [n if n else "Unknown" for n in names]
+                trackers = _create_trackers(frame, boxes)
 
         if boxes is not None and len(boxes) > 0:
-            names = get_classes(embs, labeled_paths, labeled_embs, thr=args.threshold)
-            names = [n if n else "Unknown" for n in names]
-
-            # Draw boxes and names using the existing PIL-based helper
-            annotated = _draw_faces_on_image(pil_im, boxes, names)
-            frame = cv2.cvtColor(np.array(annotated), cv2.COLOR_RGB2BGR)
+            frame = _draw_faces(frame, pil_im, boxes, names, args.pil_draw)
+        frame_idx += 1
 
         cv2.imshow("Face Recognition", frame)
         key = cv2.waitKey(30) & 0xFF  # Increased delay for better key detection